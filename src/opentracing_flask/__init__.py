@@ -1,21 +1,70 @@
-from flask import current_app, request, signals
-from opentracing import Format, child_of, global_tracer, tags
-from werkzeug.local import LocalProxy, LocalStack
+from contextvars import ContextVar
+from functools import cached_property, lru_cache
+from types import MappingProxyType
 
-_tracing_span_ctx_stack = LocalStack()
+from flask import current_app, g, request, signals
+from werkzeug.local import LocalProxy
+
+_span_stack_var: ContextVar[tuple] = ContextVar("opentracing_flask_stack", default=())
+
+_opentracing_loaded = False
+
+
+def _load_opentracing():
+    # opentracing is only needed once an extension is constructed;
+    # deferring the import keeps module import (and cold starts) light
+    global _opentracing_loaded
+    global global_tracer
+    global _TAG_COMPONENT, _TAG_HTTP_METHOD, _TAG_HTTP_URL, _TAG_SPAN_KIND
+    global _TAG_SPAN_KIND_RPC_SERVER, _TAG_HTTP_STATUS_CODE, _TAG_ERROR
+    global _FMT_HTTP_HEADERS
+
+    if _opentracing_loaded:
+        return
+
+    import opentracing
+
+    global_tracer = opentracing.global_tracer
+    _TAG_COMPONENT = opentracing.tags.COMPONENT
+    _TAG_HTTP_METHOD = opentracing.tags.HTTP_METHOD
+    _TAG_HTTP_URL = opentracing.tags.HTTP_URL
+    _TAG_SPAN_KIND = opentracing.tags.SPAN_KIND
+    _TAG_SPAN_KIND_RPC_SERVER = opentracing.tags.SPAN_KIND_RPC_SERVER
+    _TAG_HTTP_STATUS_CODE = opentracing.tags.HTTP_STATUS_CODE
+    _TAG_ERROR = opentracing.tags.ERROR
+    _FMT_HTTP_HEADERS = opentracing.Format.HTTP_HEADERS
+    _opentracing_loaded = True
+
+
+# fixed operation name for requests the upstream sampler already rejected,
+# so we skip formatting a real one for a span nobody will ever see
+_UNSAMPLED_OPERATION = "Http In [UNSAMPLED]"
+
+
+@lru_cache(maxsize=256)
+def _qualname(exc_type):
+    module = getattr(exc_type, "__module__", "")
+
+    if module:
+        return f"{module}.{exc_type.__name__}"
+
+    return exc_type.__name__
 
 
-@LocalProxy
 def current_span():
-    rv = _tracing_span_ctx_stack.top
+    stack = _span_stack_var.get()
 
-    if rv is None:
+    if not stack:
         return None
 
-    return rv[1].span
+    return stack[-1][1].span
 
 
 class OpenTracingFlask:
+    #: headers whose presence signals an inbound trace context; override
+    #: on a subclass when using a custom propagator
+    trace_context_headers = ("uber-trace-id", "traceparent", "x-b3-traceid")
+
     def __init__(
         self,
         app=None,
@@ -24,18 +73,18 @@ class OpenTracingFlask:
         trace_static=False,
         request_filter=None,
     ):
-        self._span_manager = _ActiveSpanManager()
-        self._trace_static = trace_static
+        _load_opentracing()
 
-        if request_filter is None:
-            request_filter = lambda request: True  # noqa
+        self._span_manager = _ActiveSpanManager()
+        self._skip_static_endpoint = not trace_static
+        self._op_cache = {}
 
         self._request_filter = request_filter
 
         if global_tags is None:
             global_tags = {}
 
-        self._global_tags = global_tags
+        self._global_tags = MappingProxyType(dict(global_tags))
 
         self._tracer_fn = global_tracer
 
@@ -43,50 +92,80 @@ class OpenTracingFlask:
             if callable(tracer):
                 self._tracer_fn = tracer
             else:
-                self._tracer_fn = lambda: tracer
+                self._tracer = tracer
 
         if app is not None:
             self.app = app
             self.init_app(app)
 
     def init_app(self, app):
-        if not hasattr(app, "extensions"):
-            app.extensions = {}
-
         app.extensions["tracing"] = self
+
+        # operation names are bounded by the URL map, so build them all up
+        # front; using the rule pattern keeps span names low-cardinality
+        for rule in app.url_map.iter_rules():
+            for method in rule.methods:
+                operation = f"Http In {method} {rule.rule}"
+                self._op_cache[(method, rule.endpoint)] = operation
+
         self._instrument_app(app)
 
-    @property
+    @cached_property
     def _tracer(self):
         return self._tracer_fn()
 
-    def start_active_span(self, operation, parent=None):
+    def start_active_span(self, operation, parent=None, extra_tags=None):
+        # re-entrant instrumentation (e.g. doubly instrumented template
+        # rendering) would nest a phantom span under an identical one;
+        # hand back the active span and bump its refcount instead
+        current = self._span_manager.current
+
+        if (
+            parent is None
+            and current is not None
+            and getattr(current.span, "operation_name", None) == operation
+        ):
+            self._span_manager.retain()
+            return current.span
+
+        if extra_tags:
+            if self._global_tags:
+                tags = dict(self._global_tags)
+                tags.update(extra_tags)
+            else:
+                tags = extra_tags
+        else:
+            # materialize a real dict for the tracer: MockTracer and
+            # basictracer hold the mapping by reference and mutate it in
+            # set_tag, so a read-only view would blow up downstream
+            tags = dict(self._global_tags) if self._global_tags else None
+
         scope = self._tracer.start_active_span(
-            operation_name=operation, child_of=parent, tags=self._global_tags.copy()
+            operation_name=operation, child_of=parent, tags=tags
         )
         self._span_manager.push(scope)
         return scope.span
 
     def end_active_span(self):
-        if current_span:
+        if current_span() is not None:
             scope = self._span_manager.pop()
-            scope.close()
+
+            # pop returns None while the scope is still retained
+            if scope is not None:
+                scope.close()
 
     def end_all_spans(self):
         while self._span_manager.current is not None:
             self.end_active_span()
 
     def _instrument_app(self, app):
+        # direct hooks dispatch as plain method calls; signals stay only
+        # for the events Flask does not expose as hooks
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
         signals.template_rendered.connect(self._template_rendered, app)
         signals.before_render_template.connect(self._before_template_rendered, app)
-        signals.request_started.connect(self._request_started, app)
-        signals.request_finished.connect(self._request_finished, app)
         signals.got_request_exception.connect(self._got_request_exception, app)
-        signals.request_tearing_down.connect(self._request_tearing_down, app)
-        signals.appcontext_tearing_down.connect(self._appcontext_tearing_down, app)
-        signals.appcontext_pushed.connect(self._appcontext_pushed, app)
-        signals.appcontext_popped.connect(self._appcontext_popped, app)
-        signals.message_flashed.connect(self._message_flashed, app)
         app.teardown_appcontext(lambda *_, **__: self.end_all_spans())
 
     def _template_rendered(self, sender, template, context, **extras):
@@ -95,91 +174,133 @@ class OpenTracingFlask:
     def _before_template_rendered(self, sender, template, context, **extras):
         template_name = template.name or "<STRING>"
         operation = f"Jinja Rendering: {template_name}"
-        span = self.start_active_span(operation)
-        span.set_tag("Rendering Template", template_name)
+        self.start_active_span(
+            operation, extra_tags={"Rendering Template": template_name}
+        )
 
-    def _request_started(self, sender, **extras):
-        endpoint = request.endpoint if request.endpoint else "[UNMATCHED]"
+    def _before_request(self):
+        endpoint = request.endpoint
 
-        if endpoint == "static" and not self._trace_static:
+        if endpoint is None:
+            endpoint = "[UNMATCHED]"
+        elif endpoint == "static" and self._skip_static_endpoint:
             return
 
-        if not self._request_filter(request):
+        if self._request_filter is not None and not self._request_filter(request):
             return
 
-        tracer = self._tracer
-        parent = tracer.extract(Format.HTTP_HEADERS, carrier=request.headers)
+        # only run the propagator when a trace header is actually present;
+        # untraced ingress skips the full header walk in extract
+        headers = request.headers
+        parent = None
 
-        operation = f"Http In {request.method} {request.path}"
-        span = self.start_active_span(operation, parent=parent)
-        span.set_tag(tags.COMPONENT, "Flask")
-        span.set_tag(tags.HTTP_METHOD, request.method)
-        span.set_tag(tags.HTTP_URL, request.path)
-        span.set_tag(tags.SPAN_KIND, tags.SPAN_KIND_RPC_SERVER)
+        if any(name in headers for name in self.trace_context_headers):
+            parent = self._tracer.extract(_FMT_HTTP_HEADERS, carrier=headers)
 
-        span.set_tag("endpoint", endpoint)
+        # the upstream caller already decided against sampling this trace;
+        # keep the context flowing but skip the operation name and tag work
+        if parent is not None and getattr(parent, "sampled", True) is False:
+            self.start_active_span(_UNSAMPLED_OPERATION, parent=parent)
+            return
 
-    def _request_finished(self, sender, response, **extras):
-        span = current_span
+        operation = self._op_cache.get((request.method, endpoint))
 
-        # we might not have started a span for this particular request
-        if span:
-            span.set_tag(tags.HTTP_STATUS_CODE, response.status_code)
+        if operation is None:
+            # routes registered after init_app miss the init-time
+            # snapshot; cache them from the matched rule so they keep
+            # the low-cardinality name. unmatched requests fall back to
+            # the raw path and are deliberately not cached
+            rule = request.url_rule
 
-    def _got_request_exception(self, sender, exception, **extras):
-        span = current_span
+            if rule is not None:
+                operation = f"Http In {request.method} {rule.rule}"
+                self._op_cache[(request.method, endpoint)] = operation
+            else:
+                operation = f"Http In {request.method} {request.path}"
+        extra_tags = {
+            _TAG_COMPONENT: "Flask",
+            _TAG_HTTP_METHOD: request.method,
+            _TAG_HTTP_URL: request.path,
+            _TAG_SPAN_KIND: _TAG_SPAN_KIND_RPC_SERVER,
+            "endpoint": endpoint,
+        }
+        self.start_active_span(operation, parent=parent, extra_tags=extra_tags)
+
+    def _after_request(self, response):
+        span = current_span()
 
         # we might not have started a span for this particular request
-        if span:
-            span.set_tag(tags.ERROR, True)
-            exc_type = type(exception)
-
-            module = getattr(exception, "__module__", "")
+        if span is not None:
+            span.set_tag(_TAG_HTTP_STATUS_CODE, response.status_code)
 
-            name = exc_type.__name__
+        return response
 
-            if module:
-                name = f"{module}.{exc_type.__name__}"
+    def _got_request_exception(self, sender, exception, **extras):
+        span = current_span()
 
+        # we might not have started a span for this particular request
+        if span is not None:
+            span.set_tag(_TAG_ERROR, True)
+            name = _qualname(type(exception))
             span.log_kv({"Type": name, "Message": str(exception)})
 
-    def _request_tearing_down(self, sender, **extras):
-        pass
-
-    def _appcontext_tearing_down(self, sender, **extras):
-        pass
-
-    def _appcontext_pushed(self, sender, **extras):
-        pass
-
-    def _appcontext_popped(self, sender, **extras):
-        pass
-
-    def _message_flashed(self, sender, message, category, **extras):
-        pass
-
 
 class _ActiveSpanManager:
+    # the stack is an immutable tuple of immutable entries: contexts
+    # copied for asyncio tasks or copy_current_request_context threads
+    # take a snapshot, so nothing they push or retain leaks back here
     def push(self, span):
-        _tracing_span_ctx_stack.push((self, span))
+        _span_stack_var.set(_span_stack_var.get() + ((self, span, 1),))
+
+    def retain(self):
+        stack = _span_stack_var.get()
+        manager, scope, count = stack[-1]
+        _span_stack_var.set(stack[:-1] + ((manager, scope, count + 1),))
 
     def pop(self):
-        rv = _tracing_span_ctx_stack.pop()
+        stack = _span_stack_var.get()
+        rv = stack[-1] if stack else None
 
         if rv is None or rv[0] is not self:
             raise RuntimeError(
                 "popped wrong span context ({} instead of {})".format(rv, self)
             )
 
-        return rv[1]
+        manager, scope, count = rv
+
+        # still retained by a re-entrant start_active_span; not done yet
+        if count > 1:
+            _span_stack_var.set(stack[:-1] + ((manager, scope, count - 1),))
+            return None
+
+        _span_stack_var.set(stack[:-1])
+        return scope
 
     @property
     def current(self):
-        try:
-            return _tracing_span_ctx_stack.top[1]
-        except TypeError:
+        stack = _span_stack_var.get()
+
+        if not stack:
             return None
 
+        return stack[-1][1]
+
+
+def get_tracing():
+    """Return the extension for the current app, cached on ``g``.
+
+    Prefer this over the ``tracing`` proxy in hot paths: the proxy pays
+    two LocalProxy dereferences on every attribute access, this pays one
+    dict lookup after the first call in a request.
+    """
+    extension = getattr(g, "_opentracing_flask", None)
+
+    if extension is None:
+        extension = __get_tracing()
+        g._opentracing_flask = extension
+
+    return extension
+
 
 def __get_tracing():
     try: